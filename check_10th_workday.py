@@ -5,7 +5,7 @@ Exits with code 0 if true, code 1 if false.
 """
 
 import sys
-from datetime import date, timedelta
+from datetime import date
 
 
 def is_weekday(d: date) -> bool:
@@ -15,25 +15,23 @@ def is_weekday(d: date) -> bool:
 
 def count_working_days_until(target_date: date) -> int:
     """Count working days from start of month until target date (inclusive)."""
-    year = target_date.year
-    month = target_date.month
-    
-    working_days = 0
-    current = date(year, month, 1)
-    
-    while current <= target_date:
-        if is_weekday(current):
-            working_days += 1
-        current += timedelta(days=1)
-    
-    return working_days
+    # Weekday of the 1st shifts the month onto a Monday-aligned grid: count the
+    # weekdays in the first offset + day days, minus those before the 1st.
+    offset = date(target_date.year, target_date.month, 1).weekday()
+    full_weeks, remainder = divmod(offset + target_date.day, 7)
+    return full_weeks * 5 + min(remainder, 5) - min(offset, 5)
 
 
 def main():
     today = date.today()
-    working_day_count = count_working_days_until(today)
-    
     print(f"Today is {today.strftime('%Y-%m-%d')}")
+
+    # A weekend day is never a working day, no need to count
+    if not is_weekday(today):
+        print("✗ Not the 10th working day (weekend)")
+        sys.exit(1)
+
+    working_day_count = count_working_days_until(today)
     print(f"Working day #{working_day_count} of the month")
     
     if working_day_count == 10:
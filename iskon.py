@@ -8,14 +8,19 @@ Script to process Iskon teleoperator invoices from Gmail:
 
 import os
 import base64
-import io
-from datetime import datetime, timedelta
-
+import hashlib
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.http import MediaInMemoryUpload
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = [
@@ -28,10 +33,30 @@ SCOPES = [
 SENDER_EMAIL = 'e-racun@iskon.hr'  # Email address to filter for Iskon invoices
 SEARCH_DAYS = 10 # How many days back to search
 DRIVE_FOLDER_NAME = 'Iskon'
+MIME_TYPES = {
+    '.pdf': 'application/pdf',
+    '.png': 'image/png',
+}
+ALLOWED_EXTENSIONS = tuple(MIME_TYPES)
+GMAIL_BATCH_SIZE = 50  # Gmail accepts up to 100 requests per batch but rate limits large ones
+GMAIL_RETRIES = 3  # Exponential backoff retries for requests that failed in a batch
+MESSAGE_FIELDS = 'id,payload(parts(filename,body(data,attachmentId)))'  # Only what the attachment scan reads
+UPLOAD_WORKERS = 8  # Concurrent Drive uploads, well under the per-user quota
+UPLOAD_QUEUE_SIZE = 16  # Fetched attachments waiting for an upload worker
+RESUMABLE_UPLOAD_THRESHOLD = 5 * 1024 * 1024  # Smaller files go up in a single request
+CACHE_DIR = os.path.expanduser('~/.cache/iskon')
+STATE_FILE = os.path.join(CACHE_DIR, 'state.json')  # Uploaded digests per folder
+
+_thread_local = threading.local()
+_uploaded_digests_lock = threading.Lock()
+
+# Token refreshes share one pooled session instead of opening a connection each
+_auth_session = requests.Session()
+_auth_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
 
 
 def authenticate():
-    """Authenticate and return Gmail and Drive service objects."""
+    """Authenticate and return Gmail and Drive service objects and the credentials."""
     creds = None
     # The file token.json stores the user's access and refresh tokens
     if os.path.exists('token.json'):
@@ -40,7 +65,7 @@ def authenticate():
     # If there are no (valid) credentials available, let the user log in
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+            creds.refresh(Request(session=_auth_session))
         else:
             flow = InstalledAppFlow.from_client_secrets_file(
                 'client_secret_544079871095-7eo15ghsvks1u43urcft84afblheu732.apps.googleusercontent.com.json', SCOPES)
@@ -53,14 +78,51 @@ def authenticate():
     gmail_service = build('gmail', 'v1', credentials=creds)
     drive_service = build('drive', 'v3', credentials=creds)
 
-    return gmail_service, drive_service
+    return gmail_service, drive_service, creds
+
+
+def get_thread_drive_service(creds):
+    """Return a Drive service owned by the calling thread.
+
+    Service objects share one httplib2.Http, which is not thread-safe.
+    """
+    if not hasattr(_thread_local, 'drive_service'):
+        _thread_local.drive_service = build('drive', 'v3', credentials=creds)
+    return _thread_local.drive_service
+
+
+def _load_state():
+    """Load the state cached between runs, returning an empty state if it is missing or unreadable."""
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(state):
+    """Write the cached state atomically, so overlapping runs never read a partial file."""
+    tmp_path = f'{STATE_FILE}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, STATE_FILE)
+    except OSError as e:
+        print(f'Error writing state file {STATE_FILE}: {e}')
+
+
+def _escape_query_value(value):
+    """Escape a string for use inside single quotes in a Drive query."""
+    return value.replace('\\', '\\\\').replace("'", "\\'")
 
 
 def get_or_create_drive_folder(drive_service, folder_name):
     """Get or create a folder in Google Drive."""
     # Search for existing folder
-    query = f"name='{folder_name}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
-    results = drive_service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
+    query = (f"name='{_escape_query_value(folder_name)}' and "
+             "mimeType='application/vnd.google-apps.folder' and trashed=false")
+    results = drive_service.files().list(q=query, spaces='drive', pageSize=1, fields='files(id)').execute()
     folders = results.get('files', [])
 
     if folders:
@@ -77,43 +139,159 @@ def get_or_create_drive_folder(drive_service, folder_name):
 
 def search_iskon_emails(gmail_service, days_back=30):
     """Search for emails from Iskon within the specified time period."""
-    # Calculate date for search query
-    date_filter = (datetime.now() - timedelta(days=days_back)).strftime('%Y/%m/%d')
-    query = f'from:{SENDER_EMAIL} after:{date_filter} has:attachment'
+    query = f'from:{SENDER_EMAIL} newer_than:{days_back}d has:attachment'
 
     try:
-        results = gmail_service.users().messages().list(
-            userId='me', q=query).execute()
-        messages = results.get('messages', [])
-
-        return messages
+        messages = []
+        page_token = None
+        while True:
+            results = gmail_service.users().messages().list(
+                userId='me', q=query, maxResults=100, pageToken=page_token,
+                fields='messages(id),nextPageToken').execute()
+            messages.extend(results.get('messages', []))
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return messages
     except Exception as e:
         print(f'Error searching emails: {e}')
         return []
 
 
+def _chunked(items, size):
+    """Yield successive slices of at most size items."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _attachment_parts(message):
+    """Yield (filename, body) for every PDF and PNG part of a message."""
+    # Partial responses omit empty fields, so none of them can be assumed present
+    for part in message.get('payload', {}).get('parts', []):
+        filename = part.get('filename', '')
+        body = part.get('body', {})
+        if filename.lower().endswith(ALLOWED_EXTENSIONS):
+            if 'data' in body or 'attachmentId' in body:
+                yield filename, body
+
+
+def fetch_messages(gmail_service, message_ids):
+    """Fetch full messages in Gmail batch requests, keyed by message ID."""
+    messages = {}
+
+    def _collect(request_id, response, exception):
+        if exception is not None:
+            print(f'Error getting message {request_id}: {exception}')
+            return
+        messages[request_id] = response
+
+    for chunk in _chunked(message_ids, GMAIL_BATCH_SIZE):
+        batch = gmail_service.new_batch_http_request(callback=_collect)
+        for message_id in chunk:
+            batch.add(
+                gmail_service.users().messages().get(
+                    userId='me', id=message_id, format='full', fields=MESSAGE_FIELDS),
+                request_id=message_id
+            )
+        try:
+            batch.execute()
+        except Exception as e:
+            print(f'Error fetching messages: {e}')
+
+    return messages
+
+
+def fetch_attachments(gmail_service, messages):
+    """Yield all PDF and PNG attachments of fetched messages using Gmail batch requests."""
+    pending = []
+
+    # Small attachments come inline with the message, only fetch the rest.
+    # Base64 sources are popped as they are decoded so only one copy stays alive.
+    for message_id, message in messages.items():
+        for filename, body in _attachment_parts(message):
+            if 'data' in body:
+                yield {
+                    'message_id': message_id,
+                    'filename': filename,
+                    'data': base64.urlsafe_b64decode(body.pop('data'))
+                }
+            else:
+                pending.append((message_id, filename, body['attachmentId']))
+
+    failed = []
+
+    for chunk in _chunked(pending, GMAIL_BATCH_SIZE):
+        results = {}
+
+        def _collect(request_id, response, exception):
+            if exception is not None:
+                message_id, filename, _ = chunk[int(request_id)]
+                print(f'Error getting attachment {filename} from message {message_id}: {exception}')
+                return
+            results[int(request_id)] = base64.urlsafe_b64decode(response.pop('data'))
+
+        batch = gmail_service.new_batch_http_request(callback=_collect)
+        for idx, (message_id, _, attachment_id) in enumerate(chunk):
+            batch.add(
+                gmail_service.users().messages().attachments().get(
+                    userId='me', messageId=message_id, id=attachment_id),
+                request_id=str(idx)
+            )
+        try:
+            batch.execute()
+        except Exception as e:
+            print(f'Error fetching attachments: {e}')
+
+        for idx, (message_id, filename, attachment_id) in enumerate(chunk):
+            if idx in results:
+                yield {
+                    'message_id': message_id,
+                    'filename': filename,
+                    'data': results.pop(idx)
+                }
+            else:
+                failed.append((message_id, filename, attachment_id))
+
+    # Attachments whose batch entry failed (e.g. rate limited) are retried one by one
+    for message_id, filename, attachment_id in failed:
+        print(f'Retrying attachment {filename} of message {message_id} individually...')
+        try:
+            body = gmail_service.users().messages().attachments().get(
+                userId='me', messageId=message_id, id=attachment_id).execute(num_retries=GMAIL_RETRIES)
+        except Exception as e:
+            print(f'Error getting attachment {filename} from message {message_id}: {e}')
+            continue
+
+        yield {
+            'message_id': message_id,
+            'filename': filename,
+            'data': base64.urlsafe_b64decode(body.pop('data'))
+        }
+
+
 def get_attachments(gmail_service, message_id):
-    """Get all PDF and PNG attachments from an email."""
+    """Get all PDF and PNG attachments from a single email.
+
+    Fallback for messages that could not be fetched through a batch request.
+    """
     attachments = []
 
     try:
         message = gmail_service.users().messages().get(
-            userId='me', id=message_id).execute()
-
-        if 'parts' in message['payload']:
-            for part in message['payload']['parts']:
-                filename_lower = part['filename'].lower() if part['filename'] else ''
-                if filename_lower.endswith(('.pdf', '.png')):
-                    if 'attachmentId' in part['body']:
-                        attachment = gmail_service.users().messages().attachments().get(
-                            userId='me', messageId=message_id, id=part['body']['attachmentId']
-                        ).execute()
-
-                        data = base64.urlsafe_b64decode(attachment['data'])
-                        attachments.append({
-                            'filename': part['filename'],
-                            'data': data
-                        })
+            userId='me', id=message_id, fields=MESSAGE_FIELDS).execute(num_retries=GMAIL_RETRIES)
+
+        for filename, body in _attachment_parts(message):
+            if 'data' not in body:
+                body = gmail_service.users().messages().attachments().get(
+                    userId='me', messageId=message_id, id=body['attachmentId']
+                ).execute(num_retries=GMAIL_RETRIES)
+
+            data = base64.urlsafe_b64decode(body.pop('data'))
+            attachments.append({
+                'message_id': message_id,
+                'filename': filename,
+                'data': data
+            })
 
         return attachments
     except Exception as e:
@@ -121,23 +299,99 @@ def get_attachments(gmail_service, message_id):
         return []
 
 
-def upload_to_drive(drive_service, folder_id, filename, file_data):
-    """Upload file to Google Drive."""
-    # Determine mimetype based on file extension
-    if filename.lower().endswith('.png'):
-        mimetype = 'image/png'
-    else:
-        mimetype = 'application/pdf'
-    
+def iter_attachments(gmail_service, messages):
+    """Yield the PDF and PNG attachments of all found messages as each batch completes."""
+    for chunk in _chunked(messages, GMAIL_BATCH_SIZE):
+        fetched = fetch_messages(gmail_service, [msg['id'] for msg in chunk])
+        yield from fetch_attachments(gmail_service, fetched)
+
+        for msg in chunk:
+            if msg['id'] not in fetched:
+                print(f'Retrying message {msg["id"]} individually...')
+                yield from get_attachments(gmail_service, msg['id'])
+
+
+def _produce_attachments(gmail_service, messages, attachment_queue, consumers):
+    """Queue attachments for upload, then one end-of-stream marker per consumer."""
+    try:
+        for attachment in iter_attachments(gmail_service, messages):
+            print(f'  Fetched attachment: {attachment["filename"]} (message {attachment["message_id"]})')
+            attachment_queue.put(attachment)
+    finally:
+        for _ in range(consumers):
+            attachment_queue.put(None)
+
+
+def _upload_attachments(creds, folder_id, attachment_queue, uploaded_digests):
+    """Upload queued attachments until the end-of-stream marker and return the uploaded files."""
+    drive_service = get_thread_drive_service(creds)
+    uploaded = []
+
+    while (attachment := attachment_queue.get()) is not None:
+        uploaded_file = upload_to_drive(
+            drive_service, folder_id, attachment['filename'],
+            attachment['data'], uploaded_digests
+        )
+
+        if uploaded_file:
+            uploaded.append({
+                'filename': attachment['filename'],
+                'link': uploaded_file.get('webViewLink')
+            })
+            print(f'  Uploaded {attachment["filename"]}: {uploaded_file.get("webViewLink")}')
+
+    return uploaded
+
+
+def file_already_uploaded(drive_service, folder_id, digest):
+    """Check if a file with the given SHA-256 content digest exists in the Drive folder."""
+    try:
+        query = (f"'{folder_id}' in parents and trashed=false and "
+                 f"appProperties has {{ key='sha256' and value='{digest}' }}")
+        results = drive_service.files().list(
+            q=query,
+            spaces='drive',
+            pageSize=1,
+            fields='files(id)'
+        ).execute()
+        return len(results.get('files', [])) > 0
+    except Exception as e:
+        print(f'  Error checking for existing file: {e}')
+        return False
+
+
+def upload_to_drive(drive_service, folder_id, filename, file_data, uploaded_digests):
+    """Upload file to Google Drive unless the same content was uploaded before.
+
+    uploaded_digests maps SHA-256 digests of files known to be in the folder to
+    their filenames and is shared between upload threads; a digest is reserved
+    before its upload starts.
+    """
+    digest = hashlib.sha256(file_data).hexdigest()
+
+    # Reserve the digest so a duplicate attachment in another thread is skipped
+    with _uploaded_digests_lock:
+        if digest in uploaded_digests:
+            print(f'  File already exists in Drive, skipping: {filename}')
+            return None
+        uploaded_digests[digest] = filename
+
+    if file_already_uploaded(drive_service, folder_id, digest):
+        print(f'  File already exists in Drive, skipping: {filename}')
+        return None
+
+    mimetype = MIME_TYPES.get(os.path.splitext(filename)[1].lower(), 'application/octet-stream')
+
     file_metadata = {
         'name': filename,
-        'parents': [folder_id]
+        'parents': [folder_id],
+        'appProperties': {'sha256': digest}
     }
 
-    media = MediaIoBaseUpload(
-        io.BytesIO(file_data),
+    media = MediaInMemoryUpload(
+        file_data,
         mimetype=mimetype,
-        resumable=True
+        resumable=len(file_data) > RESUMABLE_UPLOAD_THRESHOLD
     )
 
     try:
@@ -150,6 +404,8 @@ def upload_to_drive(drive_service, folder_id, filename, file_data):
         return file
     except Exception as e:
         print(f'Error uploading file to Drive: {e}')
+        with _uploaded_digests_lock:
+            uploaded_digests.pop(digest, None)
         return None
 
 
@@ -181,42 +437,48 @@ def send_notification(gmail_service, subject, body):
 
 def main():
     print('Authenticating...')
-    gmail_service, drive_service = authenticate()
-
-    print('Getting/creating Drive folder...')
-    folder_id = get_or_create_drive_folder(drive_service, DRIVE_FOLDER_NAME)
-
-    print(f'Searching for Iskon emails from last {SEARCH_DAYS} days...')
-    messages = search_iskon_emails(gmail_service, SEARCH_DAYS)
-
-    if not messages:
-        print('No emails found from Iskon')
-        return
-
-    print(f'Found {len(messages)} email(s)')
+    gmail_service, drive_service, creds = authenticate()
+    state = _load_state()
+
+    # The folder lookup only needs Drive, so it runs while Gmail is queried
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        print('Getting/creating Drive folder...')
+        folder_future = executor.submit(get_or_create_drive_folder, drive_service, DRIVE_FOLDER_NAME)
+
+        print(f'Searching for Iskon emails from last {SEARCH_DAYS} days...')
+        messages = search_iskon_emails(gmail_service, SEARCH_DAYS)
+
+        if not messages:
+            print('No emails found from Iskon')
+            return
+
+        print(f'Found {len(messages)} email(s)')
+
+        # Attachments are uploaded while the remaining ones are still being fetched
+        print('Fetching attachments and uploading them to Google Drive...')
+        attachment_queue = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+        producer = threading.Thread(
+            target=_produce_attachments,
+            args=(gmail_service, messages, attachment_queue, UPLOAD_WORKERS),
+            daemon=True
+        )
+        producer.start()
+        folder_id = folder_future.result()
 
     processed_files = []
+    uploaded_digests = state.setdefault('uploaded', {}).setdefault(folder_id, {})
 
-    for msg in messages:
-        print(f'\nProcessing message {msg["id"]}...')
-        attachments = get_attachments(gmail_service, msg['id'])
-
-        for attachment in attachments:
-            print(f'  Processing attachment: {attachment["filename"]}')
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = [
+            executor.submit(_upload_attachments, creds, folder_id, attachment_queue, uploaded_digests)
+            for _ in range(UPLOAD_WORKERS)
+        ]
 
-            # Upload to Drive
-            print('  Uploading to Google Drive...')
-            uploaded_file = upload_to_drive(
-                drive_service, folder_id, attachment['filename'],
-                attachment['data']
-            )
+        for future in as_completed(futures):
+            processed_files.extend(future.result())
 
-            if uploaded_file:
-                processed_files.append({
-                    'filename': attachment['filename'],
-                    'link': uploaded_file.get('webViewLink')
-                })
-                print(f'  Uploaded: {uploaded_file.get("webViewLink")}')
+    producer.join()
+    _save_state(state)
 
     # Send notification
     if processed_files:
@@ -11,16 +11,20 @@ import os
 import base64
 import io
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
 from datetime import datetime, timedelta
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.http import MediaInMemoryUpload, build_http
 from PIL import Image
-from pyzbar.pyzbar import decode
+from pyzbar.pyzbar import ZBarSymbol, decode
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = [
@@ -33,10 +37,29 @@ SCOPES = [
 SENDER_EMAIL = 'moj.racun@tomato.com.hr'  # Email address to filter for Iskon invoices
 SEARCH_DAYS = 10 # How many days back to search
 DRIVE_FOLDER_NAME = 'Tomato'
+GMAIL_BATCH_SIZE = 50  # Gmail accepts up to 100 requests per batch but rate limits large ones
+GMAIL_RETRIES = 3  # Exponential backoff retries for requests that failed in a batch
+MAX_PART_DEPTH = 5  # How deep nested MIME parts are requested
+UPLOAD_WORKERS = 8  # Concurrent Drive uploads, well under the per-user quota
+RESUMABLE_UPLOAD_THRESHOLD = 5 * 1024 * 1024  # Smaller files go up in a single request
+
+_IBAN_RE = re.compile(r'HR\d{19}')  # Croatian IBAN
+_REF_RE = re.compile(r'(HR\d{2}\s+\d+)')  # Payment model and reference number
+_INVOICE_RE = re.compile(r'(\d{12}-\w+-\d+)')
+_DATA_URL_RE = re.compile(r'data:image/[^;]+;base64,(.+)')
+
+# Only <img> tags are needed for barcode lookup, so the rest of the HTML is not built into a tree
+_IMG_STRAINER = SoupStrainer('img')
+
+# Barcode types found on payment slips; limiting ZBar to these skips the other scanners
+BARCODE_SYMBOLS = [ZBarSymbol.CODE128, ZBarSymbol.PDF417, ZBarSymbol.QRCODE]
+
+_thread_local = threading.local()
+_existing_names_lock = threading.Lock()
 
 
 def authenticate():
-    """Authenticate and return Gmail and Drive service objects."""
+    """Authenticate and return Gmail and Drive service objects and the credentials."""
     creds = None
     # The file token.json stores the user's access and refresh tokens
     if os.path.exists('token.json'):
@@ -55,10 +78,31 @@ def authenticate():
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
 
-    gmail_service = build('gmail', 'v1', credentials=creds)
-    drive_service = build('drive', 'v3', credentials=creds)
+    gmail_service = build('gmail', 'v1', http=_authorized_http(creds), cache_discovery=False)
+    drive_service = build('drive', 'v3', http=_authorized_http(creds), cache_discovery=False)
+
+    return gmail_service, drive_service, creds
+
+
+def _authorized_http(creds):
+    """Return an authorized HTTP client that keeps its connections alive between requests.
 
-    return gmail_service, drive_service
+    httplib2.Http is not thread-safe, so every service gets its own. build_http()
+    keeps the library's default timeout and does not follow Drive's 308 Resume
+    Incomplete responses as redirects.
+    """
+    return AuthorizedHttp(creds, http=build_http())
+
+
+def get_thread_drive_service(creds):
+    """Return a Drive service owned by the calling thread.
+
+    Service objects share one httplib2.Http, which is not thread-safe.
+    """
+    if not hasattr(_thread_local, 'drive_service'):
+        _thread_local.drive_service = build(
+            'drive', 'v3', http=_authorized_http(creds), cache_discovery=False)
+    return _thread_local.drive_service
 
 
 def get_or_create_drive_folder(drive_service, folder_name):
@@ -87,101 +131,239 @@ def search_tomato_emails(gmail_service, days_back=30):
     query = f'from:{SENDER_EMAIL} after:{date_filter} has:attachment'
 
     try:
-        results = gmail_service.users().messages().list(
-            userId='me', q=query).execute()
-        messages = results.get('messages', [])
-
-        return messages
+        messages = []
+        page_token = None
+        while True:
+            results = gmail_service.users().messages().list(
+                userId='me', q=query, maxResults=500, pageToken=page_token,
+                fields='messages/id,nextPageToken').execute()
+            messages.extend(results.get('messages', []))
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return messages
     except Exception as e:
         print(f'Error searching emails: {e}')
         return []
 
 
-def get_inline_images(gmail_service, message_id):
-    """Get all inline images (embedded in email body) from an email."""
+def _part_fields(depth):
+    """Build the fields mask for a MIME part and its sub-parts down to the given depth."""
+    fields = 'partId,mimeType,filename,headers(name,value),body(data,attachmentId)'
+    if depth > 0:
+        fields += f',parts({_part_fields(depth - 1)})'
+    return fields
+
+
+# Only the part tree the extractors read, skipping raw, snippet, labels and sizes
+MESSAGE_FIELDS = f'id,payload({_part_fields(MAX_PART_DEPTH)})'
+
+
+def _chunked(items, size):
+    """Yield successive slices of at most size items."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _walk_parts(parts):
+    """Yield every part of a message payload, including nested parts."""
+    for part in parts:
+        yield part
+        yield from _walk_parts(part.get('parts', []))
+
+
+def _warn_truncated_parts(message):
+    """Warn when a message nests parts deeper than MESSAGE_FIELDS requests them.
+
+    Sub-parts below MAX_PART_DEPTH are not returned, so attachments or inline
+    images inside them are not seen.
+    """
+    level = [message.get('payload', {})]
+    for _ in range(MAX_PART_DEPTH):
+        level = [sub for part in level for sub in part.get('parts', [])]
+
+    if any(part.get('mimeType', '').startswith('multipart/') for part in level):
+        print(f'Warning: message {message["id"]} nests parts deeper than {MAX_PART_DEPTH} levels, '
+              'attachments below them are skipped')
+
+
+def _content_id(part):
+    """Return the Content-ID of a message part without the surrounding < and >."""
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-id':
+            return header['value'].strip('<>')
+    return None
+
+
+def _is_wanted_part(part):
+    """Check if a part is an inline image or a PDF or PNG attachment."""
+    if part.get('mimeType', '').startswith('image/') and _content_id(part):
+        return True
+    filename_lower = part['filename'].lower() if part.get('filename') else ''
+    return filename_lower.endswith(('.pdf', '.png'))
+
+
+def fetch_messages(gmail_service, message_ids):
+    """Fetch full messages in Gmail batch requests, keyed by message ID."""
+    messages = {}
+
+    def _collect(request_id, response, exception):
+        if exception is not None:
+            print(f'Error getting message {request_id}: {exception}')
+            return
+        _warn_truncated_parts(response)
+        messages[request_id] = response
+
+    for chunk in _chunked(message_ids, GMAIL_BATCH_SIZE):
+        batch = gmail_service.new_batch_http_request(callback=_collect)
+        for message_id in chunk:
+            batch.add(
+                gmail_service.users().messages().get(
+                    userId='me', id=message_id, format='full', fields=MESSAGE_FIELDS),
+                request_id=message_id
+            )
+        try:
+            batch.execute()
+        except Exception as e:
+            print(f'Error fetching messages: {e}')
+
+    return messages
+
+
+def fetch_message_full(gmail_service, message_id, cache):
+    """Return a full message from cache, fetching and caching it on a miss."""
+    if message_id not in cache:
+        try:
+            cache[message_id] = gmail_service.users().messages().get(
+                userId='me', id=message_id, format='full', fields=MESSAGE_FIELDS
+            ).execute(num_retries=GMAIL_RETRIES)
+            _warn_truncated_parts(cache[message_id])
+        except Exception as e:
+            print(f'Error getting message {message_id}: {e}')
+            return None
+    return cache[message_id]
+
+
+def fetch_attachment_data(gmail_service, messages):
+    """Fetch inline images and attachments of fetched messages using Gmail batch requests.
+
+    Returns the decoded data keyed by (message_id, part_id), ready to be used as
+    the part_data cache of decode_part_data().
+    """
+    pending = [
+        (message_id, part.get('partId'), part['body']['attachmentId'])
+        for message_id, message in messages.items()
+        for part in _walk_parts(message['payload'].get('parts', []))
+        if 'data' not in part.get('body', {}) and 'attachmentId' in part.get('body', {})
+        and _is_wanted_part(part)
+    ]
+    part_data = {}
+    failed = []
+
+    for chunk in _chunked(pending, GMAIL_BATCH_SIZE):
+
+        def _collect(request_id, response, exception):
+            message_id, part_id, _ = chunk[int(request_id)]
+            if exception is not None:
+                print(f'Error getting attachment from message {message_id}: {exception}')
+                return
+            part_data[(message_id, part_id)] = base64.urlsafe_b64decode(response['data'])
+
+        batch = gmail_service.new_batch_http_request(callback=_collect)
+        for idx, (message_id, _, attachment_id) in enumerate(chunk):
+            batch.add(
+                gmail_service.users().messages().attachments().get(
+                    userId='me', messageId=message_id, id=attachment_id),
+                request_id=str(idx)
+            )
+        try:
+            batch.execute()
+        except Exception as e:
+            print(f'Error fetching attachments: {e}')
+
+        failed.extend(entry for entry in chunk if entry[:2] not in part_data)
+
+    # Attachments whose batch entry failed (e.g. rate limited) are retried one by one
+    for message_id, part_id, attachment_id in failed:
+        print(f'Retrying attachment {part_id} of message {message_id} individually...')
+        try:
+            response = gmail_service.users().messages().attachments().get(
+                userId='me', messageId=message_id, id=attachment_id).execute(num_retries=GMAIL_RETRIES)
+            part_data[(message_id, part_id)] = base64.urlsafe_b64decode(response['data'])
+        except Exception as e:
+            print(f'Error getting attachment from message {message_id}: {e}')
+
+    return part_data
+
+
+def decode_part_data(message_id, part, part_data):
+    """Return the decoded data of a message part, or None if it has none.
+
+    part_data caches decoded bytes by (message_id, part_id) for the whole run,
+    so a part used both as inline image and as attachment is decoded once.
+    Parts with inline data have no attachment ID, so the part ID is the key.
+    """
+    key = (message_id, part.get('partId'))
+    if key not in part_data:
+        body = part.get('body', {})
+        if 'data' not in body:
+            return None
+        part_data[key] = base64.urlsafe_b64decode(body['data'])
+    return part_data[key]
+
+
+def get_inline_images(message, part_data):
+    """Get all inline images (embedded in email body) from a fetched email."""
     inline_images = {}
 
     try:
-        message = gmail_service.users().messages().get(
-            userId='me', id=message_id).execute()
-
-        def extract_inline_parts(parts):
-            for part in parts:
-                # Check for nested parts
-                if 'parts' in part:
-                    extract_inline_parts(part['parts'])
-                
-                # Look for inline images
-                headers = part.get('headers', [])
-                content_id = None
-                for header in headers:
-                    if header['name'].lower() == 'content-id':
-                        # Remove < and > from Content-ID
-                        content_id = header['value'].strip('<>')
-                        break
-                
-                mime_type = part.get('mimeType', '')
-                if content_id and mime_type.startswith('image/'):
-                    # Get image data
-                    if 'attachmentId' in part.get('body', {}):
-                        attachment = gmail_service.users().messages().attachments().get(
-                            userId='me', messageId=message_id, id=part['body']['attachmentId']
-                        ).execute()
-                        data = base64.urlsafe_b64decode(attachment['data'])
-                    elif 'data' in part.get('body', {}):
-                        data = base64.urlsafe_b64decode(part['body']['data'])
-                    else:
-                        continue
-                    
-                    inline_images[content_id] = {
-                        'data': data,
-                        'mime_type': mime_type
-                    }
-
-        if 'parts' in message['payload']:
-            extract_inline_parts(message['payload']['parts'])
+        for part in _walk_parts(message['payload'].get('parts', [])):
+            # Look for inline images
+            content_id = _content_id(part)
+            mime_type = part.get('mimeType', '')
+            if content_id and mime_type.startswith('image/'):
+                data = decode_part_data(message['id'], part, part_data)
+                if data is None:
+                    continue
+
+                inline_images[content_id] = {
+                    'data': data,
+                    'mime_type': mime_type
+                }
 
         return inline_images
     except Exception as e:
-        print(f'Error getting inline images from message {message_id}: {e}')
+        print(f'Error getting inline images from message {message["id"]}: {e}')
         return {}
 
 
-def get_attachments(gmail_service, message_id):
-    """Get all PDF and PNG attachments from an email."""
+def get_attachments(message, part_data):
+    """Get all PDF and PNG attachments from a fetched email."""
     attachments = []
 
     try:
-        message = gmail_service.users().messages().get(
-            userId='me', id=message_id).execute()
-
         if 'parts' in message['payload']:
             for part in message['payload']['parts']:
-                filename_lower = part['filename'].lower() if part['filename'] else ''
+                filename_lower = part['filename'].lower() if part.get('filename') else ''
                 if filename_lower.endswith(('.pdf', '.png')):
-                    if 'attachmentId' in part['body']:
-                        attachment = gmail_service.users().messages().attachments().get(
-                            userId='me', messageId=message_id, id=part['body']['attachmentId']
-                        ).execute()
-
-                        data = base64.urlsafe_b64decode(attachment['data'])
-                        attachments.append({
-                            'filename': part['filename'],
-                            'data': data
-                        })
+                    data = decode_part_data(message['id'], part, part_data)
+                    if data is None:
+                        print(f'  Warning: no data for attachment {part["filename"]}, skipping it')
+                        continue
+                    attachments.append({
+                        'filename': part['filename'],
+                        'data': data
+                    })
 
         return attachments
     except Exception as e:
-        print(f'Error getting attachments from message {message_id}: {e}')
+        print(f'Error getting attachments from message {message["id"]}: {e}')
         return []
 
 
-def get_email_body(gmail_service, message_id):
-    """Extract HTML body from email message."""
+def get_email_body(message):
+    """Extract HTML body from a fetched email message."""
     try:
-        message = gmail_service.users().messages().get(
-            userId='me', id=message_id, format='full').execute()
-        
         payload = message['payload']
         html_body = None
         
@@ -214,28 +396,59 @@ def get_email_body(gmail_service, message_id):
         return None
 
 
-def extract_barcode_from_html(html_content, inline_images=None):
-    """Extract barcode from HTML email by finding embedded images."""
+def _decode_image_bytes(image_data):
+    """Decode the barcodes in an encoded image, scanning only BARCODE_SYMBOLS."""
+    # ZBar only reads 8-bit grayscale pixels
+    img = Image.open(io.BytesIO(image_data)).convert('L')
+    return decode(img, symbols=BARCODE_SYMBOLS)
+
+
+def _decode_images(images):
+    """Decode barcodes from several encoded images in parallel.
+
+    Yields (decoded_objects, error) per image in input order. Pillow and ZBar
+    release the GIL while decoding, so threads spread the work over the cores.
+    Closing the generator cancels the decodes that have not started yet.
+    """
+    def _safe_decode(image_data):
+        try:
+            return _decode_image_bytes(image_data), None
+        except Exception as e:
+            return [], e
+
+    if len(images) < 2:
+        yield from map(_safe_decode, images)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=min(len(images), os.cpu_count() or 1))
+    try:
+        yield from executor.map(_safe_decode, images)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def extract_img_tags(html_content):
+    """Return (src, alt) for every <img> tag in the HTML."""
+    soup = BeautifulSoup(html_content, 'html.parser', parse_only=_IMG_STRAINER)
+    return [(img.get('src', ''), img.get('alt', '')) for img in soup.find_all('img')]
+
+
+def extract_barcode_from_html(img_tags, inline_images=None):
+    """Extract barcode from the (src, alt) img tags of an HTML email.
+
+    Stops at the first image that contains a barcode.
+    """
     barcodes = []
     
-    if not html_content:
-        print('    No HTML content received')
-        return barcodes
-    
     if inline_images is None:
         inline_images = {}
     
     try:
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Find all img tags
-        img_tags = soup.find_all('img')
         print(f'    Found {len(img_tags)} image(s) in HTML')
         
-        for idx, img_tag in enumerate(img_tags):
-            src = img_tag.get('src', '')
-            alt = img_tag.get('alt', '')
-            
+        # Collect the decodable images first so they can be decoded in parallel
+        candidates = []
+        for idx, (src, alt) in enumerate(img_tags):
             print(f'    Image {idx+1}: src="{src[:100]}..." alt="{alt}"')
             
             # Check if it's a CID (Content-ID) reference
@@ -244,24 +457,7 @@ def extract_barcode_from_html(html_content, inline_images=None):
                 print(f'      Processing CID-referenced image: {cid}')
                 
                 if cid in inline_images:
-                    try:
-                        image_data = inline_images[cid]['data']
-                        img = Image.open(io.BytesIO(image_data))
-                        print(f'      Image size: {img.size}, mode: {img.mode}')
-                        decoded_objects = decode(img)
-                        
-                        if decoded_objects:
-                            print(f'      Found {len(decoded_objects)} barcode(s)!')
-                            for obj in decoded_objects:
-                                barcodes.append({
-                                    'type': obj.type,
-                                    'data': obj.data.decode('utf-8'),
-                                    'method': 'inline_cid_image'
-                                })
-                        else:
-                            print(f'      No barcode detected in this image')
-                    except Exception as e:
-                        print(f'      Error processing CID image: {e}')
+                    candidates.append((idx, inline_images[cid]['data'], 'inline_cid_image'))
                 else:
                     print(f'      CID not found in inline images')
             
@@ -269,32 +465,32 @@ def extract_barcode_from_html(html_content, inline_images=None):
             elif src.startswith('data:image'):
                 print(f'      Processing base64 embedded image...')
                 # Extract the base64 data
-                match = re.match(r'data:image/[^;]+;base64,(.+)', src)
+                match = _DATA_URL_RE.match(src)
                 if match:
                     try:
                         image_data = base64.b64decode(match.group(1))
-                        
-                        # Try to decode barcode from the image
-                        img = Image.open(io.BytesIO(image_data))
-                        print(f'      Image size: {img.size}, mode: {img.mode}')
-                        decoded_objects = decode(img)
-                        
-                        if decoded_objects:
-                            print(f'      Found {len(decoded_objects)} barcode(s)!')
-                            for obj in decoded_objects:
-                                barcodes.append({
-                                    'type': obj.type,
-                                    'data': obj.data.decode('utf-8'),
-                                    'method': 'html_embedded_image'
-                                })
-                        else:
-                            print(f'      No barcode detected in this image')
+                        candidates.append((idx, image_data, 'html_embedded_image'))
                     except Exception as e:
                         print(f'      Error processing image: {e}')
-                        continue
             else:
                 print(f'      Skipped (not base64 or CID)')
         
+        with closing(_decode_images([c[1] for c in candidates])) as results:
+            for (idx, _, method), (decoded_objects, error) in zip(candidates, results):
+                if error:
+                    print(f'    Image {idx+1}: Error decoding barcode: {error}')
+                elif decoded_objects:
+                    print(f'    Image {idx+1}: Found {len(decoded_objects)} barcode(s)!')
+                    for obj in decoded_objects:
+                        barcodes.append({
+                            'type': obj.type,
+                            'data': obj.data.decode('utf-8'),
+                            'method': method
+                        })
+                    break
+                else:
+                    print(f'    Image {idx+1}: No barcode detected in this image')
+        
         if barcodes:
             print(f'    Total: Found {len(barcodes)} barcode(s) in HTML')
         else:
@@ -318,17 +514,17 @@ def extract_payment_info_from_html(html_content):
         payment_info = {}
         
         # Extract IBAN (Croatian IBAN starts with HR)
-        iban_match = re.search(r'HR\d{19}', text)
+        iban_match = _IBAN_RE.search(text)
         if iban_match:
             payment_info['IBAN'] = iban_match.group(0)
         
         # Extract reference number (MODEL, POZIV NA BROJ)
-        ref_match = re.search(r'(HR\d{2}\s+\d+)', text)
+        ref_match = _REF_RE.search(text)
         if ref_match:
             payment_info['Reference'] = ref_match.group(1)
         
         # Extract invoice number pattern
-        invoice_match = re.search(r'(\d{12}-\w+-\d+)', text)
+        invoice_match = _INVOICE_RE.search(text)
         if invoice_match:
             payment_info['Invoice'] = invoice_match.group(1)
         
@@ -350,9 +546,7 @@ def extract_barcode_from_attachment(file_data, filename):
     
     try:
         print(f'    Attempting to decode barcode from PNG attachment: {filename}')
-        img = Image.open(io.BytesIO(file_data))
-        print(f'    Image size: {img.size}, mode: {img.mode}')
-        decoded_objects = decode(img)
+        decoded_objects = _decode_image_bytes(file_data)
         
         if decoded_objects:
             print(f'    Found {len(decoded_objects)} barcode(s)!')
@@ -370,29 +564,50 @@ def extract_barcode_from_attachment(file_data, filename):
     return barcodes
 
 
-def file_exists_in_drive(drive_service, folder_id, filename):
-    """Check if a file with the given name already exists in the Drive folder."""
+def list_folder_filenames(drive_service, folder_id):
+    """Return the names of all files in the Drive folder."""
+    filenames = set()
+
     try:
-        query = f"name='{filename}' and '{folder_id}' in parents and trashed=false"
-        results = drive_service.files().list(
-            q=query,
-            spaces='drive',
-            fields='files(id, name)'
-        ).execute()
-        files = results.get('files', [])
-        return len(files) > 0
+        query = f"'{folder_id}' in parents and trashed=false"
+        page_token = None
+        while True:
+            results = drive_service.files().list(
+                q=query,
+                spaces='drive',
+                pageSize=1000,
+                pageToken=page_token,
+                fields='nextPageToken, files(name)'
+            ).execute()
+            filenames.update(f['name'] for f in results.get('files', []))
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return filenames
     except Exception as e:
-        print(f'    Error checking for existing file: {e}')
-        return False
+        print(f'Error listing files in Drive folder: {e}')
+        return filenames
+
+
+def load_drive_folder(drive_service, folder_name):
+    """Get or create the Drive folder and return its ID with the names of its files."""
+    folder_id = get_or_create_drive_folder(drive_service, folder_name)
+    return folder_id, list_folder_filenames(drive_service, folder_id)
+
 
+def upload_to_drive(drive_service, folder_id, filename, file_data, existing_names, description=None):
+    """Upload file to Google Drive if it doesn't already exist.
 
-def upload_to_drive(drive_service, folder_id, filename, file_data, description=None):
-    """Upload file to Google Drive if it doesn't already exist."""
+    existing_names holds the names of the files in the folder and is shared
+    between upload threads; a name is reserved before its upload starts.
+    """
     # Check if file already exists
-    if file_exists_in_drive(drive_service, folder_id, filename):
-        print(f'    File already exists in Drive, skipping: {filename}')
-        return None
-    
+    with _existing_names_lock:
+        if filename in existing_names:
+            print(f'    File already exists in Drive, skipping: {filename}')
+            return None
+        existing_names.add(filename)
+
     # Determine mimetype based on file extension
     if filename.lower().endswith('.png'):
         mimetype = 'image/png'
@@ -407,10 +622,10 @@ def upload_to_drive(drive_service, folder_id, filename, file_data, description=N
     if description:
         file_metadata['description'] = description
 
-    media = MediaIoBaseUpload(
-        io.BytesIO(file_data),
+    media = MediaInMemoryUpload(
+        file_data,
         mimetype=mimetype,
-        resumable=True
+        resumable=len(file_data) > RESUMABLE_UPLOAD_THRESHOLD
     )
 
     try:
@@ -423,6 +638,8 @@ def upload_to_drive(drive_service, folder_id, filename, file_data, description=N
         return file
     except Exception as e:
         print(f'Error uploading file to Drive: {e}')
+        with _existing_names_lock:
+            existing_names.discard(filename)
         return None
 
 
@@ -454,79 +671,82 @@ def send_notification(gmail_service, subject, body):
 
 def main():
     print('Authenticating...')
-    gmail_service, drive_service = authenticate()
+    gmail_service, drive_service, creds = authenticate()
 
-    print('Getting/creating Drive folder...')
-    folder_id = get_or_create_drive_folder(drive_service, DRIVE_FOLDER_NAME)
+    # The Drive folder lookup does not depend on Gmail, so it runs alongside it
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        print('Getting/creating Drive folder...')
+        folder_future = executor.submit(load_drive_folder, drive_service, DRIVE_FOLDER_NAME)
 
-    print(f'Searching for Tomato emails from last {SEARCH_DAYS} days...')
-    messages = search_tomato_emails(gmail_service, SEARCH_DAYS)
+        print(f'Searching for Tomato emails from last {SEARCH_DAYS} days...')
+        messages = search_tomato_emails(gmail_service, SEARCH_DAYS)
 
-    if not messages:
-        print('No emails found from Tomato')
-        return
+        if not messages:
+            print('No emails found from Tomato')
+            return
+
+        print(f'Found {len(messages)} email(s)')
 
-    print(f'Found {len(messages)} email(s)')
+        print('Fetching messages...')
+        fetched = fetch_messages(gmail_service, [msg['id'] for msg in messages])
+
+        # Messages whose batch entry failed (e.g. rate limited) are retried one by one
+        for msg in messages:
+            if msg['id'] not in fetched:
+                print(f'Retrying message {msg["id"]} individually...')
+                fetch_message_full(gmail_service, msg['id'], fetched)
+
+        print('Fetching attachments...')
+        part_data = fetch_attachment_data(gmail_service, fetched)
+
+        folder_id, existing_names = folder_future.result()
 
     processed_files = []
+    uploads = []
 
     for msg in messages:
         print(f'\nProcessing message {msg["id"]}...')
-        
+        message = fetched.get(msg['id'])
+        if message is None:
+            print('  Skipped, message could not be fetched')
+            continue
+
         # Get inline images (contains barcode images)
         print('  Extracting inline images...')
-        inline_images = get_inline_images(gmail_service, msg['id'])
+        inline_images = get_inline_images(message, part_data)
         print(f'  Found {len(inline_images)} inline image(s)')
         
         # Extract HTML body to identify barcode image
         print('  Extracting HTML body...')
-        html_body = get_email_body(gmail_service, msg['id'])
+        html_body = get_email_body(message)
         
         # Find the barcode image CID from HTML
         barcode_cid = None
         if html_body:
-            soup = BeautifulSoup(html_body, 'html.parser')
-            for img in soup.find_all('img'):
-                alt = img.get('alt', '').lower()
-                if 'kod' in alt or 'plaćanje' in alt or 'payment' in alt or 'barcode' in alt:
-                    src = img.get('src', '')
+            for src, alt in extract_img_tags(html_body):
+                alt_lower = alt.lower()
+                if 'kod' in alt_lower or 'plaćanje' in alt_lower or 'payment' in alt_lower or 'barcode' in alt_lower:
                     if src.startswith('cid:'):
                         barcode_cid = src[4:]  # Remove 'cid:' prefix
-                        print(f'  Found payment barcode image: CID={barcode_cid}, alt="{img.get("alt", "")}"')
+                        print(f'  Found payment barcode image: CID={barcode_cid}, alt="{alt}"')
                         break
         
         # Get PDF attachments
-        attachments = get_attachments(gmail_service, msg['id'])
+        attachments = get_attachments(message, part_data)
         pdf_filename = None
         
-        # Upload PDF attachments
+        # Queue PDF attachments for upload
         for attachment in attachments:
             if attachment['filename'].lower().endswith('.pdf'):
                 print(f'  Processing PDF: {attachment["filename"]}')
                 pdf_filename = attachment['filename']
-                
-                uploaded_file = upload_to_drive(
-                    drive_service, folder_id, attachment['filename'],
-                    attachment['data'], None
-                )
-                
-                if uploaded_file:
-                    processed_files.append({
-                        'filename': attachment['filename'],
-                        'link': uploaded_file.get('webViewLink'),
-                        'type': 'PDF',
-                        'status': 'uploaded'
-                    })
-                    print(f'  Uploaded PDF: {uploaded_file.get("webViewLink")}')
-                else:
-                    processed_files.append({
-                        'filename': attachment['filename'],
-                        'link': None,
-                        'type': 'PDF',
-                        'status': 'skipped'
-                    })
+                uploads.append({
+                    'filename': attachment['filename'],
+                    'data': attachment['data'],
+                    'type': 'PDF'
+                })
         
-        # Upload the barcode image if found
+        # Queue the barcode image for upload if found
         if barcode_cid and barcode_cid in inline_images:
             # Create filename based on PDF name
             if pdf_filename:
@@ -536,31 +756,45 @@ def main():
                 barcode_filename = f'Tomato_barcode_{msg["id"]}.png'
             
             print(f'  Processing barcode image: {barcode_filename}')
-            
-            uploaded_file = upload_to_drive(
-                drive_service, folder_id, barcode_filename,
-                inline_images[barcode_cid]['data'], None
-            )
-            
+            uploads.append({
+                'filename': barcode_filename,
+                'data': inline_images[barcode_cid]['data'],
+                'type': 'Barcode Image'
+            })
+        elif barcode_cid:
+            print(f'  Warning: Barcode CID {barcode_cid} not found in inline images')
+        else:
+            print(f'  No barcode image found in email')
+
+    def _upload(upload):
+        return upload_to_drive(
+            get_thread_drive_service(creds), folder_id,
+            upload['filename'], upload['data'], existing_names
+        )
+
+    print(f'\nUploading {len(uploads)} file(s) to Google Drive...')
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = {executor.submit(_upload, upload): upload for upload in uploads}
+
+        for future in as_completed(futures):
+            upload = futures[future]
+            uploaded_file = future.result()
+
             if uploaded_file:
                 processed_files.append({
-                    'filename': barcode_filename,
+                    'filename': upload['filename'],
                     'link': uploaded_file.get('webViewLink'),
-                    'type': 'Barcode Image',
+                    'type': upload['type'],
                     'status': 'uploaded'
                 })
-                print(f'  Uploaded barcode: {uploaded_file.get("webViewLink")}')
+                print(f'  Uploaded {upload["type"]} {upload["filename"]}: {uploaded_file.get("webViewLink")}')
             else:
                 processed_files.append({
-                    'filename': barcode_filename,
+                    'filename': upload['filename'],
                     'link': None,
-                    'type': 'Barcode Image',
+                    'type': upload['type'],
                     'status': 'skipped'
                 })
-        elif barcode_cid:
-            print(f'  Warning: Barcode CID {barcode_cid} not found in inline images')
-        else:
-            print(f'  No barcode image found in email')
 
     # Send notification
     if processed_files: